@@ -0,0 +1,27 @@
+"""
+Standalone benchmarks, run from the project root, e.g. `python -m benchmarks.occupancy`.
+Every benchmark works on a throwaway test database.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+import django
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plushcare.settings')
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+@contextmanager
+def timed(label: str, iterations: int = 1):
+    started = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - started
+    print(f'{label:<45} {elapsed * 1000:10.1f} ms total {elapsed / iterations * 1e6:10.1f} us/op')
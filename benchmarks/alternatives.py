@@ -0,0 +1,89 @@
+"""Alternative slots search for a clinic of 1,000 doctors: inline vs process pool."""
+import random
+import time
+from datetime import timedelta
+
+from benchmarks import setup, timed
+
+setup()
+
+from django.utils import timezone  # noqa: E402
+
+from booking.alternatives import AlternativeSlotsEngine  # noqa: E402
+from booking.models import Doctor, DoctorDayOccupancy, Patient  # noqa: E402
+from booking.occupancy import SLOTS_PER_DAY, to_bytes  # noqa: E402
+from booking.range import VisitTime  # noqa: E402
+
+DOCTORS = 1000
+DAYS = 21
+SEARCHES = 20
+
+
+def populate():
+    """Busy clinic: every doctor has a handful of free gaps per day"""
+    Doctor.objects.bulk_create(
+        Doctor(name=f'doctor {n}', email='d@x.com', specialization='cardiology') for n in range(DOCTORS)
+    )
+    Patient.objects.create(name='patient', email='p@x.com')
+    doctor_ids = list(Doctor.objects.filter(specialization='cardiology').values_list('pk', flat=True))
+    today = timezone.localdate()
+    rnd = random.Random(42)
+    rows = []
+    for doctor_id in doctor_ids:
+        for offset in range(DAYS):
+            bitmap = (1 << SLOTS_PER_DAY) - 1
+            for _ in range(3):
+                gap = rnd.randrange(SLOTS_PER_DAY - 12)
+                bitmap &= ~(((1 << rnd.randrange(2, 12)) - 1) << gap)
+            rows.append(DoctorDayOccupancy(doctor_id=doctor_id, day=today + timedelta(days=offset), bitmap=to_bytes(bitmap)))
+    DoctorDayOccupancy.objects.bulk_create(rows)
+    return doctor_ids, today
+
+
+def _key(suggested):
+    return [(doctor_id, visit.start) for doctor_id, visit in suggested]
+
+
+def main():
+    doctor_ids, today = populate()
+    rnd = random.Random(7)
+    start_day = today + timedelta(days=7 - today.weekday())
+    visits = []
+    for _ in range(SEARCHES):
+        start = timezone.make_aware(timezone.datetime.combine(
+            start_day + timedelta(days=rnd.randrange(5)), timezone.datetime.min.time(),
+        )) + timedelta(hours=9, minutes=5 * rnd.randrange(90))
+        visits.append((rnd.choice(doctor_ids), VisitTime(start, start + timedelta(minutes=rnd.choice([15, 30, 45])))))
+    print(f'{DOCTORS} doctors, {DoctorDayOccupancy.objects.count()} bitmaps')
+
+    inline = AlternativeSlotsEngine(inline_below=DOCTORS + 1, budget=60)
+    with timed('inline search', SEARCHES):
+        expected = [_key(inline.suggest(visit, 1, doctor_id)[0]) for doctor_id, visit in visits]
+
+    for chunk_size in (50, 125, 250):
+        pooled = AlternativeSlotsEngine(inline_below=0, chunk_size=chunk_size, budget=60)
+        pooled.suggest(visits[0][1], 1, visits[0][0])  # warm up the workers
+        with timed(f'process pool ({pooled.workers} workers, {chunk_size} doctors/task)', SEARCHES):
+            results = [_key(pooled.suggest(visit, 1, doctor_id)[0]) for doctor_id, visit in visits]
+        assert results == expected
+        pooled.shutdown()
+
+    for budget in (0.01, 0.06, 0.08):
+        for name, engine in (
+                ('inline', AlternativeSlotsEngine(inline_below=DOCTORS + 1, budget=budget)),
+                ('pool', AlternativeSlotsEngine(inline_below=0, chunk_size=50, budget=budget)),
+        ):
+            engine.suggest(visits[0][1], 1, visits[0][0])  # warm up the workers
+            partial = found = worst = 0
+            for doctor_id, visit in visits:
+                started = time.perf_counter()
+                suggested, complete = engine.suggest(visit, 1, doctor_id)
+                worst = max(worst, time.perf_counter() - started)
+                partial += not complete
+                found += len(suggested)
+            print(f'budget {budget * 1000:.0f} ms, {name}: worst {worst * 1000:.1f} ms, '
+                  f'{partial}/{SEARCHES} partial, {found / SEARCHES:.1f} suggestions/search')
+            engine.shutdown()
+
+if __name__ == '__main__':
+    main()
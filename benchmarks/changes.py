@@ -0,0 +1,65 @@
+"""Client sync of 100k appointments: change feed deltas vs re-downloading every day."""
+import json
+from datetime import datetime, timedelta
+
+from benchmarks import setup, timed
+
+setup()
+
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from booking.models import Appointment  # noqa: E402
+
+APPOINTMENTS = 100000
+DAYS = 365
+CHANGES = 100
+
+
+def populate():
+    first_day = timezone.make_aware(datetime(2021, 1, 4, 9))
+    per_day = APPOINTMENTS // DAYS + 1
+    Appointment.objects.bulk_create(
+        Appointment(
+            doctor_id=1 + n % 2,
+            patient_id=1,
+            appointment_start=first_day + timedelta(days=n // per_day, minutes=n % per_day),
+            appointment_finish=first_day + timedelta(days=n // per_day, minutes=n % per_day + 1),
+        )
+        for n in range(APPOINTMENTS)
+    )
+    return first_day.date()
+
+
+def sync(label, client, urls):
+    transferred = 0
+    with CaptureQueriesContext(connection) as queries, timed(label):
+        for url in urls:
+            response = client.get(url)
+            assert response.status_code == 200
+            transferred += len(response.content)
+    print(f'{"":<45} {len(urls)} requests, {len(queries)} queries, {transferred / 1024:.0f} KiB')
+
+
+def main():
+    first_day = populate()
+    client = Client()
+    cursor = json.loads(client.get(reverse('changes')).content)['cursor']
+
+    step = APPOINTMENTS // CHANGES
+    for appointment in Appointment.objects.order_by('id')[::step]:
+        appointment.status = Appointment.AppointmentStatus.CANCELLED
+        appointment.save()
+    print(f'{APPOINTMENTS} appointments, {CHANGES} changed since the last sync')
+
+    sync('full reload (every day)', client, [
+        reverse('perday', args=(first_day + timedelta(days=day),)) for day in range(DAYS)
+    ])
+    sync('change feed', client, [f'{reverse("changes")}?since={cursor}'])
+
+
+if __name__ == '__main__':
+    main()
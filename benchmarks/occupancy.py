@@ -0,0 +1,76 @@
+"""Conflict checks: occupancy bitmap lookup vs appointments range scan."""
+import random
+from datetime import datetime, timedelta
+
+from benchmarks import setup, timed
+
+setup()
+
+from django.db.models import Q  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from booking import occupancy  # noqa: E402
+from booking.booking_service import BookingService  # noqa: E402
+from booking.models import Appointment, Doctor, Patient  # noqa: E402
+from booking.occupancy import OccupancyService, overlapping  # noqa: E402
+from booking.range import VisitTime  # noqa: E402
+
+DOCTORS = 50
+DAYS = 365
+APPOINTMENTS_PER_DAY = 6
+CHECKS = 5000
+
+
+def _working_days():
+    # 2021-01-04 is a Monday
+    return [day for day in range(DAYS) if day % 7 < 5]
+
+
+def populate():
+    Doctor.objects.bulk_create(Doctor(name=f'doctor {n}', email='d@x.com') for n in range(DOCTORS))
+    doctor_ids = list(Doctor.objects.values_list('pk', flat=True))
+    patient = Patient.objects.create(name='patient', email='p@x.com')
+    first_day = timezone.make_aware(datetime(2021, 1, 4, 9))
+    appointments = [
+        Appointment(
+            doctor_id=doctor_id,
+            patient=patient,
+            appointment_start=first_day + timedelta(days=day, hours=slot * 1.5),
+            appointment_finish=first_day + timedelta(days=day, hours=slot * 1.5, minutes=40),
+        )
+        for doctor_id in doctor_ids for day in _working_days() for slot in range(APPOINTMENTS_PER_DAY)
+    ]
+    Appointment.objects.bulk_create(appointments)
+    with timed(f'rebuild bitmaps ({len(appointments)} appointments)'):
+        occupancy.rebuild()
+    return doctor_ids, first_day
+
+
+def main():
+    doctor_ids, first_day = populate()
+    rnd = random.Random(42)
+    visits = []
+    for _ in range(CHECKS):
+        start = first_day + timedelta(days=rnd.choice(_working_days()), minutes=5 * rnd.randrange(90))
+        visits.append((rnd.choice(doctor_ids), VisitTime(start, start + timedelta(minutes=rnd.choice([20, 45, 140])))))
+
+    with timed('range scan (doctor conflict)', CHECKS):
+        scan = [Appointment.objects.filter(overlapping(visit), doctor_id=doctor_id).exists()
+                for doctor_id, visit in visits]
+    with timed('occupancy bitmap (doctor conflict)', CHECKS):
+        bitmap = [OccupancyService.is_doctor_busy(doctor_id, visit) for doctor_id, visit in visits]
+    print(f'agreement: {sum(a == b for a, b in zip(scan, bitmap))}/{CHECKS}')
+
+    with timed('range scan (full availability check)', CHECKS):
+        for doctor_id, visit in visits:
+            Appointment.objects.filter(overlapping(visit) & (Q(patient_id=1) | Q(doctor_id=doctor_id))).exists()
+    with timed('bitmap (full availability check)', CHECKS):
+        for doctor_id, visit in visits:
+            BookingService.check_appointment_time_availability(1, doctor_id, visit)
+    with timed('free intervals', CHECKS):
+        for doctor_id, visit in visits:
+            OccupancyService.free_intervals(doctor_id, visit.start.date())
+
+
+if __name__ == '__main__':
+    main()
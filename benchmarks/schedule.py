@@ -0,0 +1,74 @@
+"""Working hours checks across 20 time zones: per-call conversion vs compiled UTC intervals."""
+import random
+from datetime import datetime, timedelta
+
+import pytz
+
+from benchmarks import setup, timed
+
+setup()
+
+from django.core.signals import request_finished, request_started  # noqa: E402
+
+from booking.booking_service import WorkingDayAndHourAvailabilityFilter  # noqa: E402
+from booking.models import Clinic, Doctor  # noqa: E402
+from booking.range import HoursRange, VisitTime  # noqa: E402
+from booking.schedule import to_timestamp, working_interval_at, working_intervals  # noqa: E402
+
+TIMEZONES = [
+    'UTC', 'Europe/London', 'Europe/Berlin', 'Europe/Kiev', 'Europe/Moscow', 'Africa/Cairo', 'Asia/Dubai',
+    'Asia/Kolkata', 'Asia/Kathmandu', 'Asia/Shanghai', 'Asia/Tokyo', 'Australia/Adelaide', 'Australia/Sydney',
+    'Pacific/Auckland', 'America/Sao_Paulo', 'America/New_York', 'America/Chicago', 'America/Denver',
+    'America/Los_Angeles', 'Pacific/Honolulu',
+]
+CHECKS = 100000
+
+
+def converting_check(visit: VisitTime, tz_name: str) -> bool:
+    """What the check costs when converting to the clinic's wall clock on every call"""
+    tz = pytz.timezone(tz_name)
+    start, end = visit.start.astimezone(tz), visit.end.astimezone(tz)
+    hours = HoursRange(9, 18)
+    return start.weekday() < 5 and start.date() == end.date() and hours(start) and hours(end)
+
+
+def main():
+    doctor_ids = []
+    for tz_name in TIMEZONES:
+        clinic = Clinic.objects.create(name=tz_name, timezone=tz_name)
+        doctor_ids.append(Doctor.objects.create(name=tz_name, email='d@x.com', clinic=clinic).pk)
+
+    rnd = random.Random(42)
+    first = datetime(2021, 1, 1, tzinfo=pytz.utc)
+    checks = []
+    for _ in range(CHECKS):
+        n = rnd.randrange(len(TIMEZONES))
+        start = first + timedelta(days=rnd.randrange(365), minutes=5 * rnd.randrange(282))
+        checks.append((doctor_ids[n], TIMEZONES[n], VisitTime(start, start + timedelta(minutes=30))))
+
+    # doctors' time zones are looked up once per request, run the checks as a single one
+    request_started.send(sender=None)
+    working_hours = WorkingDayAndHourAvailabilityFilter()
+    working_hours(checks[0][2], 1, checks[0][0])
+
+    with timed('per-call conversion', len(checks)):
+        expected = [converting_check(visit, tz_name) for _, tz_name, visit in checks]
+    with timed('compiled intervals (cold cache)', len(checks)):
+        cold = [working_hours(visit, 1, doctor_id)[0] for doctor_id, _, visit in checks]
+    for _ in range(3):  # the machine is noisy, repeat the warm runs
+        with timed('per-call conversion', len(checks)):
+            expected = [converting_check(visit, tz_name) for _, tz_name, visit in checks]
+        with timed('compiled intervals (warm cache)', len(checks)):
+            warm = [working_hours(visit, 1, doctor_id)[0] for doctor_id, _, visit in checks]
+    request_finished.send(sender=None)
+    stamps = [(tz_name, to_timestamp(visit.start)) for _, tz_name, visit in checks]
+    with timed('interval lookup only (timestamps given)', len(checks)):
+        [working_interval_at(ts, tz_name) for tz_name, ts in stamps]
+    info = working_intervals.cache_info()
+    print(f'{len(TIMEZONES)} time zones, {info.currsize} (tz, day) intervals compiled')
+    print(f'agreement: {sum(a == b for a, b in zip(expected, warm))}/{len(checks)}')
+    assert cold == warm
+
+
+if __name__ == '__main__':
+    main()
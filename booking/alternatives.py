@@ -0,0 +1,249 @@
+"""
+Suggesting alternative slots when a booking is rejected.
+
+Candidates are the requested doctor and the doctors sharing the same specialization. Their
+occupancy bitmaps are loaded once, the search itself is pure integer work which is fanned
+out across a process pool in chunks of doctors. The latency budget is a deadline every search
+checks on its own, so it returns what it has found so far instead of holding a worker.
+"""
+import heapq
+import itertools
+import os
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor, wait
+from datetime import date, datetime, timedelta
+
+import pytz
+from django.db.models import Case, IntegerField, Value, When
+from django.utils import timezone
+
+from booking.models import Appointment, Doctor, DoctorDayOccupancy
+from booking.occupancy import FULL_DAY, SLOT_MINUTES, SLOT_SECONDS, SLOTS_PER_DAY, from_bytes, interval_mask
+from booking.range import VisitTime
+from booking.schedule import doctor_timezones, from_timestamp, local_date, to_timestamp, working_intervals
+
+# (distance, is other doctor, doctor_id, start timestamp)
+Candidate = typing.Tuple[int, bool, int, int]
+
+# share of the budget kept for the search, loading bitmaps stops before
+SEARCH_SHARE = 0.5
+# pool tasks stop this early, so their results reach the parent process within the budget
+HANDOVER = 0.005
+
+
+def _nearest_in_day(fits: int, pivot: int) -> typing.Tuple[typing.Iterator[int], typing.Iterator[int]]:
+    """Start slots before and from `pivot`, each side ordered nearest first"""
+    def below(bits):
+        while bits:
+            slot = bits.bit_length() - 1
+            bits ^= 1 << slot
+            yield slot
+
+    def above(bits):
+        while bits:
+            lowest = bits & -bits
+            bits ^= lowest
+            yield pivot + lowest.bit_length() - 1
+
+    return below(fits & ((1 << pivot) - 1)), above(fits >> pivot)
+
+
+def search_chunk(
+        candidates: typing.List[typing.Tuple[int, int, int]],
+        blocked: typing.List[typing.Tuple[float, float]],
+        doctor_id: int,
+        target: int,
+        not_before: int,
+        duration: int,
+        limit: int,
+        deadline: float,
+) -> typing.Tuple[typing.List[Candidate], bool]:
+    """
+    Nearest free starts for a chunk of (doctor_id, opening timestamp, bitmap) working days.
+    Runs in pool workers, so it works on plain integers only.
+    :param blocked: patient's own appointments as timestamps
+    :param duration: visit duration in seconds
+    :param deadline: time.time() to stop at, the candidates found so far are returned
+    :return: tuple ([candidate], complete)
+    """
+    duration_slots = -(-duration // SLOT_SECONDS)
+    # working hours are exclusive of the closing hour, so the visit has to finish before it
+    last_start = (SLOTS_PER_DAY * SLOT_SECONDS - duration - 1) // SLOT_SECONDS
+    day_length = SLOTS_PER_DAY * SLOT_SECONDS
+    blocked_masks: typing.Dict[int, int] = {}
+
+    def lower_bound(day_start: int) -> int:
+        return max(day_start - target, target - day_start - day_length, 0)
+
+    # the best `limit` candidates so far, negated to keep the worst one on top of the heap
+    best: typing.List[Candidate] = []
+    complete = True
+    for candidate_id, start_of_day, bitmap in sorted(candidates, key=lambda candidate: lower_bound(candidate[1])):
+        if len(best) == limit and lower_bound(start_of_day) > -best[0][0]:
+            break  # days are sorted by distance, nothing closer is left
+        if time.time() >= deadline:
+            complete = False
+            break
+        if start_of_day not in blocked_masks:
+            blocked_masks[start_of_day] = 0
+            for start, end in blocked:
+                blocked_masks[start_of_day] |= interval_mask(start, end, start_of_day)
+        free = ~(bitmap | blocked_masks[start_of_day]) & FULL_DAY
+        fits = free & ((1 << (last_start + 1)) - 1)
+        for shift in range(1, duration_slots):  # bit i set when slots i ... i + duration - 1 are free
+            fits &= free >> shift
+        if not_before > start_of_day:
+            fits &= ~((1 << -(-(not_before - start_of_day) // SLOT_SECONDS)) - 1)
+        pivot = min(max(-(-(target - start_of_day) // SLOT_SECONDS), 0), SLOTS_PER_DAY)
+        for side in _nearest_in_day(fits, pivot):
+            for slot in side:
+                start = start_of_day + slot * SLOT_SECONDS
+                key = (-abs(start - target), -(candidate_id != doctor_id), -candidate_id, -start)
+                if len(best) < limit:
+                    heapq.heappush(best, key)
+                elif key > best[0]:
+                    heapq.heapreplace(best, key)
+                else:
+                    break  # the side is ordered by distance, the rest is worse
+    return sorted((-distance, bool(-other), -pk, -start) for distance, other, pk, start in best), complete
+
+
+class AlternativeSlotsEngine:
+    def __init__(self, limit=5, horizon_days=7, budget=0.5, chunk_size=100, inline_below=200, workers=None):
+        """
+        :param limit: number of alternatives to suggest
+        :param horizon_days: days around the requested one to look at
+        :param budget: latency budget in seconds, results found so far are returned on timeout
+        :param chunk_size: doctors per pool task
+        :param inline_below: searches with fewer doctors are done in process, without the pool
+        """
+        self.limit = limit
+        self.horizon_days = horizon_days
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.inline_below = inline_below
+        self.workers = workers or os.cpu_count()
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def suggest(self, visit: VisitTime, user_id, doctor_id) -> (typing.List[typing.Tuple[int, VisitTime]], bool):
+        """
+        Nearest free visits of the same duration with the doctor or colleagues of the same specialization.
+        :return: tuple ([(doctor_id, visit)], complete), `complete` is False when the budget ran out
+        """
+        deadline = time.time() + self.budget
+        duration = visit.end - visit.start
+        if duration >= timedelta(minutes=SLOTS_PER_DAY * SLOT_MINUTES):
+            return [], True
+
+        colleagues = Doctor.objects.filter(
+            specialization__in=Doctor.objects.filter(pk=doctor_id).values('specialization'),
+        )
+        timezones = doctor_timezones(colleagues)
+        if doctor_id not in timezones:
+            return [], True
+        requested = to_timestamp(visit.start)
+        requested_day = local_date(requested, timezones[doctor_id])
+        days = self._days(requested_day, timezones[doctor_id])
+        if not days:
+            return [], True
+
+        bitmaps, loaded_days = self._bitmaps(colleagues, days, requested_day, deadline - self.budget * SEARCH_SHARE)
+        candidates = [
+            (pk, day_start, bitmaps.get((pk, day), 0))
+            for pk, tz_name in timezones.items() for day in loaded_days
+            for day_start, _ in working_intervals(tz_name, day)
+        ]
+        args = (
+            self._patient_appointments(user_id, candidates),
+            doctor_id,
+            int(requested),
+            int(time.time()),
+            int(duration.total_seconds()),
+            self.limit,
+        )
+
+        if len(timezones) < self.inline_below:
+            found, complete = search_chunk(candidates, *args, deadline)
+        else:
+            # candidates are grouped by doctor, doctors have a different number of working days
+            doctors = [list(days) for _, days in itertools.groupby(candidates, key=lambda candidate: candidate[0])]
+            futures = [
+                self.pool.submit(
+                    search_chunk,
+                    [candidate for days in doctors[i:i + self.chunk_size] for candidate in days],
+                    *args,
+                    deadline - HANDOVER,
+                )
+                for i in range(0, len(doctors), self.chunk_size)
+            ]
+            done, not_done = wait(futures, timeout=max(deadline - time.time(), 0))
+            for future in not_done:
+                future.cancel()  # tasks already running stop on their own at the deadline
+            found = [item for future in done for item in future.result()[0]]
+            complete = not not_done and all(future.result()[1] for future in done)
+
+        return [
+            (candidate_id, self._visit(start, duration, timezones[candidate_id]))
+            for _, _, candidate_id, start in heapq.nsmallest(self.limit, found)
+        ], complete and len(loaded_days) == len(days)
+
+    @staticmethod
+    def _bitmaps(doctors, days: typing.List[date], requested_day: date, deadline: float):
+        """
+        Bitmaps of the days nearest to the requested one first, until the deadline.
+        :return: tuple ({(doctor_id, day): bitmap}, [days loaded entirely])
+        """
+        nearest = sorted(days, key=lambda day: (abs(day - requested_day), day))
+        rank = Case(*[When(day=day, then=Value(n)) for n, day in enumerate(nearest)], output_field=IntegerField())
+        rows = DoctorDayOccupancy.objects.filter(
+            doctor__in=doctors, day__range=(days[0], days[-1]),
+        ).annotate(rank=rank).order_by('rank').values_list('doctor_id', 'rank', 'bitmap')
+
+        bitmaps = {}
+        for row_doctor, day_rank, bitmap in rows.iterator():
+            if time.time() >= deadline:
+                return bitmaps, nearest[:day_rank]  # the day being read is incomplete
+            bitmaps[(row_doctor, nearest[day_rank])] = from_bytes(bitmap)
+        return bitmaps, nearest
+
+    def _days(self, day: date, tz_name: str) -> typing.List[date]:
+        today = timezone.localtime(timezone=pytz.timezone(tz_name)).date()
+        days = (day + timedelta(days=offset) for offset in range(-self.horizon_days, self.horizon_days + 1))
+        return [d for d in days if d >= today]
+
+    @staticmethod
+    def _patient_appointments(user_id, candidates) -> typing.List[typing.Tuple[float, float]]:
+        if not candidates:
+            return []
+        range_start = min(day_start for _, day_start, _ in candidates)
+        range_end = max(day_start for _, day_start, _ in candidates) + SLOTS_PER_DAY * SLOT_SECONDS
+        return [
+            (to_timestamp(start), to_timestamp(finish))
+            for start, finish in Appointment.objects.filter(
+                patient_id=user_id,
+                status__in=Appointment.BLOCKING_STATUSES,
+                appointment_start__lte=from_timestamp(range_end),
+                appointment_finish__gte=from_timestamp(range_start),
+            ).values_list('appointment_start', 'appointment_finish')
+        ]
+
+    @staticmethod
+    def _visit(start: int, duration: timedelta, tz_name: str) -> VisitTime:
+        """Visits are given in the doctor's time zone, so they stay within one calendar day"""
+        visit_start = datetime.fromtimestamp(start, pytz.timezone(tz_name))
+        return VisitTime(visit_start, visit_start + duration)
+
+
+engine = AlternativeSlotsEngine()
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class BookingConfig(AppConfig):
     name = 'booking'
+
+    def ready(self):
+        from booking import changes, occupancy, schedule
+        occupancy.connect_signals()
+        schedule.connect_signals()
+        changes.connect_signals()
@@ -4,10 +4,10 @@ from datetime import datetime
 
 import typing
 
-from django.db.models import Q
-
-from booking.range import VisitTime, HoursRange, Range
+from booking import schedule
+from booking.range import VisitTime
 from booking.models import Appointment
+from booking.occupancy import OccupancyService, overlapping
 
 
 class BookingService:
@@ -20,13 +20,8 @@ class BookingService:
         )
 
     @staticmethod
-    def appointments_fall_in_range(user_id, doctor_id, visit: VisitTime):
-        from_date, to_date = visit.start, visit.end
-        return Appointment.objects.filter(
-            (Q(patient_id=user_id) | Q(doctor_id=doctor_id)) & (
-                    Q(appointment_start__lte=to_date) & Q(appointment_finish__gte=from_date)
-            )
-        )
+    def patient_appointments_fall_in_range(user_id, visit: VisitTime):
+        return Appointment.objects.filter(overlapping(visit), patient_id=user_id)
 
     @staticmethod
     def check_appointment_time_availability(user_id, doctor_id, visit_time: VisitTime):
@@ -54,29 +49,38 @@ class CompositeAvailabilityFilter(AvailabilityFilter):
 
 class WorkingDayAndHourAvailabilityFilter(AvailabilityFilter):
     def __call__(self, visit: VisitTime, user_id, doctor_id) -> (bool, typing.List[str]):
-        """Check if appointment could be made due to hospital working hours"""
-        week_day = visit.start.weekday()  # Monday == 0 ... Sunday == 6
+        """Check if appointment could be made due to hospital working hours in the doctor's time zone"""
+        tz_name = schedule.doctor_timezone(doctor_id)
+        start, end = schedule.to_timestamp(visit.start), schedule.to_timestamp(visit.end)
 
-        if not (0 <= week_day < 5):
-            return False, ["Booking couldn't be made on the weekend."]
-
-        hours_range = self.get_working_hours_range(visit.start)
+        hours = self.get_working_hours(start, tz_name)
+        if hours is not None and end < hours[1]:
+            return True, []
 
-        matches_range = hours_range(visit.start) and hours_range(visit.end)
-        is_valid = matches_range and week_day == visit.end.weekday(), ["Close hours."]
-        return is_valid
+        if schedule.local_date(start, tz_name).weekday() not in schedule.WORKING_WEEKDAYS:
+            return False, ["Booking couldn't be made on the weekend."]
+        return False, ["Close hours."]
 
-    def get_working_hours_range(self, _: datetime) -> Range:
-        """Lookup schedule and retrieve working hours for a specific date"""
-        return HoursRange(9, 18)
+    def get_working_hours(self, ts: float, tz_name: str) -> typing.Optional[schedule.Interval]:
+        """Lookup schedule and retrieve working hours containing the timestamp"""
+        return schedule.working_interval_at(ts, tz_name)
 
 
 class SlotAvailabilityFilter(AvailabilityFilter):
-    """Checking the slot availability"""
+    """
+    Checking the slot availability. Doctor's time is looked up in the occupancy bitmap, when it
+    can't tell the doctor's appointments are checked together with the patient's ones.
+    """
 
     def __call__(self, visit: VisitTime, user_id, doctor_id) -> (bool, typing.List[str]):
-        conflicting_appointments = BookingService.appointments_fall_in_range(user_id, doctor_id, visit)
-        return not len(conflicting_appointments), ["Time slot already taken."]
+        doctor_conflict = OccupancyService.doctor_conflict(doctor_id, visit)
+        if doctor_conflict:
+            return False, ["Time slot already taken."]
+
+        appointments = BookingService.patient_appointments_fall_in_range(user_id, visit)
+        if doctor_conflict is None:
+            appointments |= Appointment.objects.filter(overlapping(visit), doctor_id=doctor_id)
+        return not appointments.exists(), ["Time slot already taken."]
 
 
 filter = CompositeAvailabilityFilter([WorkingDayAndHourAvailabilityFilter(), SlotAvailabilityFilter()])
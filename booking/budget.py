@@ -0,0 +1,14 @@
+"""
+SQL query budgets of views.
+
+Only declares the budget, it is enforced by booking.query_audit while the tests run.
+"""
+
+
+def query_budget(max_queries: int):
+    """Declare the maximum number of SQL queries a single request to the view may take"""
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
@@ -0,0 +1,100 @@
+"""
+Change feed of appointments.
+
+Every save and delete of an Appointment appends an AppointmentChange in the same
+transaction (transactional outbox). Clients keep the id of the last change they have seen
+as a cursor and fetch only what changed after it, optionally waiting for new changes.
+
+Ids are assigned on insert, not on commit. For a cursor to never skip a change, the changes
+of a patient have to become visible in id order: the patient row is locked before the
+change is inserted and stays locked until the commit, so the outbox writes of a patient are
+serialized while other patients' ones are not held up.
+"""
+import json
+import time
+import typing
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
+from django.forms import model_to_dict
+
+from booking.models import Appointment, AppointmentChange, Patient
+
+POLL_INTERVAL = 0.5
+MAX_WAIT = 30
+MAX_LIMIT = 1000
+
+
+def serialize(appointment: Appointment) -> dict:
+    """Appointment as served by the API"""
+    return model_to_dict(appointment)
+
+
+class ChangeFeed:
+
+    @staticmethod
+    def get_changes(user_id, since: int, limit: int) -> typing.List[AppointmentChange]:
+        return list(AppointmentChange.objects.filter(patient_id=user_id, id__gt=since)[:limit])
+
+    @staticmethod
+    def wait_for_changes(user_id, since: int, limit: int, wait: float) -> typing.List[AppointmentChange]:
+        """Long poll: return as soon as there are changes after the cursor or the wait is over"""
+        deadline = time.monotonic() + min(wait, MAX_WAIT)
+        while True:
+            changes = ChangeFeed.get_changes(user_id, since, limit)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                return changes
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+
+def _append(instance: Appointment, action: str, version: int, payload: str = '', patient_id=None):
+    patient_id = instance.patient_id if patient_id is None else patient_id
+    list(Patient.objects.select_for_update().filter(pk=patient_id).values_list('pk', flat=True))
+    AppointmentChange.objects.create(
+        appointment_id=instance.pk,
+        patient_id=patient_id,
+        action=action,
+        version=version,
+        payload=payload,
+    )
+
+
+def _remember_patient(sender, instance: Appointment, **kwargs):
+    loaded = instance.pk and 'patient_id' not in instance.get_deferred_fields()
+    instance._changes_patient_id = instance.patient_id if loaded else None
+
+
+def _on_save(sender, instance: Appointment, created: bool, **kwargs):
+    changes = [(
+        instance.patient_id,
+        AppointmentChange.Action.CREATED if created else AppointmentChange.Action.UPDATED,
+        json.dumps(serialize(instance), cls=DjangoJSONEncoder),
+    )]
+    previous = getattr(instance, '_changes_patient_id', None)
+    if not created and previous is not None and previous != instance.patient_id:
+        # moved to another patient, it is gone from the feed of the previous one
+        changes.append((previous, AppointmentChange.Action.DELETED, ''))
+    # patient rows are locked in the order of their ids, concurrent moves don't deadlock
+    for patient_id, action, payload in sorted(changes, key=lambda change: change[0]):
+        _append(instance, action, instance.version, payload, patient_id=patient_id)
+    instance._changes_patient_id = instance.patient_id
+
+
+def _lock_version(sender, instance: Appointment, **kwargs):
+    # the instance being deleted may be stale, the deleted version follows the last saved one
+    version = Appointment.objects.select_for_update().filter(pk=instance.pk).values_list('version', flat=True).first()
+    if version is not None:
+        instance.version = version
+
+
+def _on_delete(sender, instance: Appointment, **kwargs):
+    _append(instance, AppointmentChange.Action.DELETED, instance.version + 1)
+
+
+def connect_signals():
+    """QuerySet.update() and bulk_create() bypass signals and are not part of the feed"""
+    post_init.connect(_remember_patient, sender=Appointment, dispatch_uid='changes_init')
+    post_save.connect(_on_save, sender=Appointment, dispatch_uid='changes_save')
+    pre_delete.connect(_lock_version, sender=Appointment, dispatch_uid='changes_pre_delete')
+    post_delete.connect(_on_delete, sender=Appointment, dispatch_uid='changes_delete')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from booking import occupancy
+
+
+class Command(BaseCommand):
+    help = 'Recompute doctor occupancy bitmaps from appointments and report the drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--verify', action='store_true', help='Only report the drift, do not fix it')
+
+    def handle(self, *args, batch_size, verify, **options):
+        report = occupancy.rebuild(batch_size=batch_size, dry_run=verify)
+        if not report.drift:
+            self.stdout.write(self.style.SUCCESS(f'No drift, {report}'))
+        elif verify:
+            self.stdout.write(self.style.WARNING(f'Drift found, {report}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Drift fixed, {report}'))
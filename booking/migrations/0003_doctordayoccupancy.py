@@ -0,0 +1,51 @@
+# Generated by Django 3.0.3 on 2026-10-19 13:54
+import itertools
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Appointment.BLOCKING_STATUSES, historical models don't carry it
+BLOCKING_STATUSES = ('OPEN', 'USED', 'NO_SHOW')
+
+
+def backfill_bitmaps(apps, _):
+    """Bitmaps of the existing appointments, signals keep them in sync from now on"""
+    from booking.occupancy import expected_bitmaps, to_bytes
+
+    Appointment = apps.get_model('booking', 'Appointment')
+    DoctorDayOccupancy = apps.get_model('booking', 'DoctorDayOccupancy')
+    appointments = Appointment.objects.filter(
+        status__in=BLOCKING_STATUSES,
+    ).order_by('doctor_id').values_list('doctor_id', 'appointment_start', 'appointment_finish')
+
+    for doctor_id, rows in itertools.groupby(appointments.iterator(), key=lambda row: row[0]):
+        # doctors have no time zone of their own yet, they all work in TIME_ZONE
+        expected = expected_bitmaps(((start, finish) for _, start, finish in rows), settings.TIME_ZONE)
+        DoctorDayOccupancy.objects.bulk_create(
+            DoctorDayOccupancy(doctor_id=doctor_id, day=day, bitmap=to_bytes(bitmap))
+            for day, bitmap in expected.items()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0002_populate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorDayOccupancy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('bitmap', models.BinaryField(default=bytes)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='booking.Doctor')),
+            ],
+            options={
+                'unique_together': {('doctor', 'day')},
+            },
+        ),
+        migrations.RunPython(backfill_bitmaps, migrations.RunPython.noop),
+    ]
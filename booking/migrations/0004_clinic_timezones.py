@@ -0,0 +1,37 @@
+# Generated by Django 3.0.3 on 2026-10-19 14:03
+
+import booking.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0003_doctordayoccupancy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Clinic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('name', models.CharField(max_length=300)),
+                ('timezone', models.CharField(max_length=64, validators=[booking.models.validate_timezone])),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='doctor',
+            name='timezone',
+            field=models.CharField(blank=True, max_length=64, validators=[booking.models.validate_timezone]),
+        ),
+        migrations.AddField(
+            model_name='doctor',
+            name='clinic',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='booking.Clinic'),
+        ),
+    ]
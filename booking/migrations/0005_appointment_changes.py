@@ -0,0 +1,42 @@
+# Generated by Django 3.0.3 on 2026-10-19 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0004_clinic_timezones'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('appointment_id', models.IntegerField()),
+                ('patient_id', models.IntegerField()),
+                ('action', models.CharField(choices=[('CREATED', 'Created'), ('UPDATED', 'Updated'), ('DELETED', 'Deleted')], max_length=10)),
+                ('version', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payload', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentchange',
+            index=models.Index(fields=['patient_id', 'id'], name='booking_app_patient_5da89a_idx'),
+        ),
+    ]
@@ -1,12 +1,44 @@
-from django.db import models
+import pytz
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.db.models import PROTECT, CASCADE
 
 
+def validate_timezone(value):
+    if value and value not in pytz.all_timezones_set:
+        raise ValidationError(f'Unknown time zone {value}.')
+
+
+class Clinic(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+    name = models.CharField(max_length=300)
+    timezone = models.CharField(max_length=64, validators=[validate_timezone])
+
+    def save(self, *args, **kwargs):
+        # occupancy bitmaps of the clinic's doctors move to the new time zone in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f'{self.name} ({self.timezone}) <{self.created_at.isoformat()}>'
+
+    class Meta:
+        ordering = ['created_at']
+
+
 class Doctor(models.Model):
     email = models.EmailField()
     created_at = models.DateTimeField(auto_now_add=True)
     name = models.CharField(max_length=300)
     specialization = models.CharField(max_length=300)
+    clinic = models.ForeignKey(Clinic, on_delete=PROTECT, null=True, blank=True)
+    # overrides the clinic's time zone, working hours are evaluated in it
+    timezone = models.CharField(max_length=64, blank=True, validators=[validate_timezone])
+
+    def save(self, *args, **kwargs):
+        # occupancy bitmaps move to the new time zone in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.name} <{self.created_at.isoformat()}>'
@@ -41,6 +73,8 @@ class Appointment(models.Model):
     doctor = models.ForeignKey(Doctor, on_delete=PROTECT)
     patient = models.ForeignKey(Patient, on_delete=CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    version = models.PositiveIntegerField(default=1)
 
     appointment_start = models.DateTimeField()
     appointment_finish = models.DateTimeField()
@@ -51,8 +85,73 @@ class Appointment(models.Model):
         default=AppointmentStatus.OPEN,
     )
 
+    # statuses that keep the doctor's and patient's time reserved
+    BLOCKING_STATUSES = (AppointmentStatus.OPEN, AppointmentStatus.USED, AppointmentStatus.NO_SHOW)
+
     class Meta:
         ordering = ["created_at"]
 
+    def save(self, *args, **kwargs):
+        version = self.version
+        try:
+            # post_save handlers (occupancy bitmaps, change feed) must commit together with the appointment
+            with transaction.atomic():
+                if not self._state.adding:
+                    # the row lock orders concurrent saves, each of them gets its own version
+                    current = Appointment.objects.select_for_update().filter(
+                        pk=self.pk,
+                    ).values_list('version', flat=True).first()
+                    self.version = (version if current is None else current) + 1
+                    if kwargs.get('update_fields') is not None:
+                        # partial saves are changes too, the version has to reach the database
+                        kwargs['update_fields'] = {*kwargs['update_fields'], 'version', 'updated_at'}
+                super().save(*args, **kwargs)
+        except Exception:
+            self.version = version
+            raise
+
     def __str__(self):
         return f'{self.id} {self.doctor.name}-{self.patient.name} ({self.status.capitalize()}) <{self.created_at.isoformat()}>'
+
+
+class DoctorDayOccupancy(models.Model):
+    """
+    Denormalized per (doctor, day) occupancy bitmap, one bit per 5 minutes of working hours.
+    Maintained by booking.occupancy on every Appointment save/delete.
+    """
+    doctor = models.ForeignKey(Doctor, on_delete=CASCADE)
+    day = models.DateField()
+    bitmap = models.BinaryField(default=bytes)
+
+    class Meta:
+        unique_together = [('doctor', 'day')]
+
+    def __str__(self):
+        return f'{self.doctor_id} {self.day.isoformat()} <{self.bitmap.hex()}>'
+
+
+class AppointmentChange(models.Model):
+    """
+    Outbox of appointment changes, written in the same transaction as the change itself.
+    The id is the change feed cursor.
+    """
+
+    class Action(models.TextChoices):
+        CREATED = 'CREATED'
+        UPDATED = 'UPDATED'
+        DELETED = 'DELETED'
+
+    appointment_id = models.IntegerField()
+    patient_id = models.IntegerField()
+    action = models.CharField(max_length=10, choices=Action.choices)
+    version = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # JSON of the appointment as served by the API, empty for deletes
+    payload = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [models.Index(fields=['patient_id', 'id'])]
+
+    def __str__(self):
+        return f'{self.id} {self.action.capitalize()} {self.appointment_id} v{self.version} <{self.created_at.isoformat()}>'
@@ -0,0 +1,350 @@
+"""
+Per (doctor, day) occupancy bitmaps.
+
+Working hours of a doctor's local day are split into 5 minute slots (108 slots for 9-18),
+bit `i` is set when slot `i` is taken by at least one blocking appointment of the doctor.
+Checking whether a doctor is free or listing free slots is then a single-row lookup plus
+bitwise operations. Slots are anchored to the UTC start of the working hours compiled by
+booking.schedule, so all the arithmetic is done on timestamps.
+
+Appointments overlap when their [start, finish) intervals intersect, back-to-back visits do
+not. A slot only partially covered by a visit can't tell on its own, such edge slots are
+confirmed against Appointment.
+"""
+import itertools
+import typing
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_init, post_save
+
+from booking.models import Appointment, Clinic, Doctor, DoctorDayOccupancy
+from booking.range import VisitTime
+from booking.schedule import (
+    CLOSING_HOUR, OPENING_HOUR, clear_doctor_timezones, doctor_timezone, doctor_timezones, from_timestamp, local_date,
+    to_timestamp, working_intervals,
+)
+
+SLOT_MINUTES = 5
+SLOT_SECONDS = SLOT_MINUTES * 60
+SLOTS_PER_DAY = (CLOSING_HOUR - OPENING_HOUR) * 60 // SLOT_MINUTES
+BITMAP_BYTES = (SLOTS_PER_DAY + 7) // 8
+FULL_DAY = (1 << SLOTS_PER_DAY) - 1
+
+
+def _slot(offset: float, round_up: bool) -> int:
+    """Index of the slot `offset` seconds after opening falls into, clipped to the working hours"""
+    slot, remainder = divmod(offset, SLOT_SECONDS)
+    if round_up and remainder:
+        slot += 1
+    return min(max(int(slot), 0), SLOTS_PER_DAY)
+
+
+def _mask(first: int, last: int) -> int:
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def interval_mask(start: float, end: float, day_start: int) -> int:
+    """Bits of the slots touched by the [start, end) interval of timestamps, for a day opening at `day_start`"""
+    return _mask(_slot(start - day_start, round_up=False), _slot(end - day_start, round_up=True))
+
+
+def covered_mask(start: float, end: float, day_start: int) -> int:
+    """Bits of the slots entirely within the [start, end) interval of timestamps"""
+    return _mask(_slot(start - day_start, round_up=True), _slot(end - day_start, round_up=False))
+
+
+def overlapping(visit: VisitTime) -> Q:
+    """Blocking appointments intersecting the visit, the overlap rule of both doctors and patients"""
+    return Q(
+        status__in=Appointment.BLOCKING_STATUSES,
+        appointment_start__lt=visit.end,
+        appointment_finish__gt=visit.start,
+    )
+
+
+def working_days(start: float, end: float, tz_name: str) -> typing.List[typing.Tuple[date, int]]:
+    """Local working days touched by the [start, end] interval with the timestamp they open at"""
+    first_day, last_day = local_date(start, tz_name), local_date(end, tz_name)
+    days = []
+    for n in range((last_day - first_day).days + 1):
+        day = first_day + timedelta(days=n)
+        for day_start, _ in working_intervals(tz_name, day):
+            days.append((day, day_start))
+    return days
+
+
+def to_bytes(bitmap: int) -> bytes:
+    return bitmap.to_bytes(BITMAP_BYTES, 'little')
+
+
+def from_bytes(value) -> int:
+    return int.from_bytes(bytes(value), 'little') if value else 0
+
+
+def compute_bitmap(intervals: typing.Iterable[typing.Tuple[datetime, datetime]], day_start: int) -> int:
+    bitmap = 0
+    for start, end in intervals:
+        bitmap |= interval_mask(to_timestamp(start), to_timestamp(end), day_start)
+    return bitmap
+
+
+class OccupancyService:
+
+    @staticmethod
+    def get_bitmap(doctor_id, day: date) -> int:
+        value = DoctorDayOccupancy.objects.filter(doctor_id=doctor_id, day=day).values_list('bitmap', flat=True).first()
+        return from_bytes(value)
+
+    @staticmethod
+    def doctor_conflict(doctor_id, visit: VisitTime) -> typing.Optional[bool]:
+        """
+        Single row lookup per visit day instead of scanning the appointments range. A taken slot
+        the visit covers entirely is a conflict. None when only the partially covered edge slots
+        are taken, the doctor's appointments have to tell then.
+        """
+        start, end = to_timestamp(visit.start), to_timestamp(visit.end)
+        days = working_days(start, end, doctor_timezone(doctor_id))
+        if not days:
+            return False
+        rows = dict(DoctorDayOccupancy.objects.filter(
+            doctor_id=doctor_id, day__in=[day for day, _ in days],
+        ).values_list('day', 'bitmap'))
+
+        on_edges = False
+        for day, day_start in days:
+            bitmap = from_bytes(rows.get(day))
+            if bitmap & covered_mask(start, end, day_start):
+                return True
+            on_edges = on_edges or bool(bitmap & interval_mask(start, end, day_start))
+        return None if on_edges else False
+
+    @staticmethod
+    def is_doctor_busy(doctor_id, visit: VisitTime) -> bool:
+        conflict = OccupancyService.doctor_conflict(doctor_id, visit)
+        if conflict is None:
+            return Appointment.objects.filter(overlapping(visit), doctor_id=doctor_id).exists()
+        return conflict
+
+    @staticmethod
+    def free_intervals(doctor_id, day: date) -> typing.List[typing.Tuple[datetime, datetime]]:
+        """Maximal free intervals of the doctor within the working hours of `day`"""
+        hours = working_intervals(doctor_timezone(doctor_id), day)
+        if not hours:
+            return []
+        (day_start, _), = hours
+        free = ~OccupancyService.get_bitmap(doctor_id, day) & FULL_DAY
+        intervals, slot = [], 0
+        while free:
+            skip = (free & -free).bit_length() - 1  # lowest free slot
+            free >>= skip
+            slot += skip
+            run = (~free & (free + 1)).bit_length() - 1  # length of the free run
+            intervals.append((
+                from_timestamp(day_start + slot * SLOT_SECONDS),
+                from_timestamp(day_start + (slot + run) * SLOT_SECONDS),
+            ))
+            free >>= run
+            slot += run
+        return intervals
+
+    @staticmethod
+    def compute(doctor_id, day: date) -> int:
+        hours = working_intervals(doctor_timezone(doctor_id), day)
+        if not hours:
+            return 0
+        (day_start, day_end), = hours
+        appointments = Appointment.objects.filter(
+            doctor_id=doctor_id,
+            status__in=Appointment.BLOCKING_STATUSES,
+            appointment_start__lt=from_timestamp(day_end),
+            appointment_finish__gt=from_timestamp(day_start),
+        ).values_list('appointment_start', 'appointment_finish')
+        return compute_bitmap(appointments, day_start)
+
+    @staticmethod
+    def refresh(doctor_id, day: date):
+        """Recompute the bitmap of a single (doctor, day) from Appointment: lock, recompute and write"""
+        with transaction.atomic():
+            row = DoctorDayOccupancy.objects.select_for_update().filter(doctor_id=doctor_id, day=day).first()
+            if row is None:
+                try:
+                    with transaction.atomic():
+                        DoctorDayOccupancy.objects.create(
+                            doctor_id=doctor_id, day=day, bitmap=to_bytes(OccupancyService.compute(doctor_id, day)),
+                        )
+                    return
+                except IntegrityError:
+                    # created by a concurrent first booking of the day, recompute once it is committed
+                    row = DoctorDayOccupancy.objects.select_for_update().get(doctor_id=doctor_id, day=day)
+            row.bitmap = to_bytes(OccupancyService.compute(doctor_id, day))
+            row.save(update_fields=['bitmap'])
+
+
+class RebuildReport:
+    def __init__(self):
+        self.checked = 0
+        self.created = 0
+        self.updated = 0
+        self.deleted = 0
+
+    @property
+    def drift(self) -> int:
+        return self.created + self.updated + self.deleted
+
+    def __str__(self):
+        return (f'checked {self.checked} bitmaps: {self.created} missing, '
+                f'{self.updated} outdated, {self.deleted} stale')
+
+
+def rebuild(batch_size: int = 1000, dry_run: bool = False) -> RebuildReport:
+    """
+    Recompute all bitmaps from Appointment, one doctor at a time, and fix the drift.
+    With `dry_run` only report what would be changed.
+    """
+    report = RebuildReport()
+    timezones = doctor_timezones(Doctor.objects.all())
+    appointments = Appointment.objects.filter(
+        status__in=Appointment.BLOCKING_STATUSES,
+    ).order_by('doctor_id').values_list('doctor_id', 'appointment_start', 'appointment_finish')
+
+    for doctor_id, rows in itertools.groupby(appointments.iterator(chunk_size=batch_size), key=lambda row: row[0]):
+        tz_name = timezones.get(doctor_id, settings.TIME_ZONE)
+        expected = expected_bitmaps(((start, finish) for _, start, finish in rows), tz_name)
+        _sync_doctor(doctor_id, expected, batch_size, dry_run, report)
+
+    # doctors without any blocking appointment left
+    orphans = DoctorDayOccupancy.objects.exclude(
+        doctor_id__in=Appointment.objects.filter(status__in=Appointment.BLOCKING_STATUSES).values('doctor_id')
+    )
+    for doctor_id in orphans.values_list('doctor_id', flat=True).distinct():
+        _sync_doctor(doctor_id, {}, batch_size, dry_run, report)
+    return report
+
+
+def resync_doctor(doctor_id, batch_size: int = 1000) -> RebuildReport:
+    """Recompute all bitmaps of a doctor, e.g. once the working hours moved to another time zone"""
+    report = RebuildReport()
+    appointments = Appointment.objects.filter(
+        doctor_id=doctor_id, status__in=Appointment.BLOCKING_STATUSES,
+    ).values_list('appointment_start', 'appointment_finish')
+    expected = expected_bitmaps(appointments.iterator(chunk_size=batch_size), doctor_timezone(doctor_id))
+    _sync_doctor(doctor_id, expected, batch_size, False, report)
+    return report
+
+
+def expected_bitmaps(appointments: typing.Iterable[typing.Tuple[datetime, datetime]], tz_name: str) -> typing.Dict[date, int]:
+    """Bitmaps per local day of a doctor's blocking (start, finish) appointments"""
+    expected: typing.Dict[date, int] = {}
+    for start, finish in appointments:
+        start, finish = to_timestamp(start), to_timestamp(finish)
+        for day, day_start in working_days(start, finish, tz_name):
+            mask = interval_mask(start, finish, day_start)
+            if mask:
+                expected[day] = expected.get(day, 0) | mask
+    return expected
+
+
+def _sync_doctor(doctor_id, expected: typing.Dict[date, int], batch_size: int, dry_run: bool, report: RebuildReport):
+    stored = {row.day: row for row in DoctorDayOccupancy.objects.filter(doctor_id=doctor_id)}
+    to_create, to_update, to_delete = [], [], []
+
+    for day, bitmap in expected.items():
+        row = stored.pop(day, None)
+        if row is None:
+            to_create.append(DoctorDayOccupancy(doctor_id=doctor_id, day=day, bitmap=to_bytes(bitmap)))
+        elif from_bytes(row.bitmap) != bitmap:
+            row.bitmap = to_bytes(bitmap)
+            to_update.append(row)
+    # empty bitmaps are left behind by cancellations and deletes, they are not a drift
+    to_delete = [row.pk for row in stored.values() if from_bytes(row.bitmap)]
+
+    report.checked += len(expected) + len(to_delete)
+    report.created += len(to_create)
+    report.updated += len(to_update)
+    report.deleted += len(to_delete)
+    if dry_run:
+        return
+    with transaction.atomic():
+        DoctorDayOccupancy.objects.bulk_create(to_create)
+        DoctorDayOccupancy.objects.bulk_update(to_update, ['bitmap'], batch_size=batch_size)
+        for i in range(0, len(to_delete), batch_size):
+            DoctorDayOccupancy.objects.filter(pk__in=to_delete[i:i + batch_size]).delete()
+
+
+def _occupancy_keys(doctor_id, start: datetime, finish: datetime) -> typing.Set[typing.Tuple[int, date]]:
+    if doctor_id is None or start is None or finish is None:
+        return set()
+    days = working_days(to_timestamp(start), to_timestamp(finish), doctor_timezone(doctor_id))
+    return {(doctor_id, day) for day, _ in days}
+
+
+def _scheduled(instance: Appointment) -> typing.Tuple:
+    return instance.doctor_id, instance.appointment_start, instance.appointment_finish
+
+
+def _remember_schedule(sender, instance: Appointment, **kwargs):
+    # keys are only computed on save/delete, loading appointments stays free of extra queries
+    loaded = instance.pk and not instance.get_deferred_fields() & {'doctor_id', 'appointment_start', 'appointment_finish'}
+    instance._occupancy_schedule = _scheduled(instance) if loaded else (None, None, None)
+
+
+def _previous_keys(instance: Appointment) -> typing.Set[typing.Tuple[int, date]]:
+    return _occupancy_keys(*getattr(instance, '_occupancy_schedule', (None, None, None)))
+
+
+def _on_save(sender, instance: Appointment, **kwargs):
+    # refresh both the old and the new (doctor, day) when an appointment is moved
+    for doctor_id, day in _occupancy_keys(*_scheduled(instance)) | _previous_keys(instance):
+        OccupancyService.refresh(doctor_id, day)
+    instance._occupancy_schedule = _scheduled(instance)
+
+
+def _on_delete(sender, instance: Appointment, **kwargs):
+    for doctor_id, day in _occupancy_keys(*_scheduled(instance)) | _previous_keys(instance):
+        OccupancyService.refresh(doctor_id, day)
+
+
+# fields the time zone of the working hours depends on
+_ZONE_FIELDS = {Doctor: ('timezone', 'clinic_id'), Clinic: ('timezone',)}
+
+
+def _zone(instance) -> typing.Tuple:
+    return tuple(getattr(instance, field) for field in _ZONE_FIELDS[type(instance)])
+
+
+def _remember_zone(sender, instance, **kwargs):
+    loaded = instance.pk and not instance.get_deferred_fields() & set(_ZONE_FIELDS[sender])
+    instance._occupancy_zone = _zone(instance) if loaded else None
+
+
+def _on_zone_save(sender, instance, created: bool, **kwargs):
+    # bitmaps are laid out on the working hours of the doctor's time zone, move them along
+    previous, instance._occupancy_zone = getattr(instance, '_occupancy_zone', None), _zone(instance)
+    if created or previous == instance._occupancy_zone:
+        return
+    clear_doctor_timezones()
+    if sender is Doctor:
+        doctors = [instance.pk]
+    else:
+        doctors = Doctor.objects.filter(clinic=instance, timezone='').values_list('pk', flat=True)
+    for doctor_id in doctors:
+        resync_doctor(doctor_id)
+
+
+def connect_signals():
+    """
+    Keep bitmaps in sync with Appointment, and with the time zones of doctors and clinics.
+    QuerySet.update() and bulk_create() bypass signals, run `manage.py rebuild_occupancy`
+    after such bulk changes.
+    """
+    post_init.connect(_remember_schedule, sender=Appointment, dispatch_uid='occupancy_init')
+    post_save.connect(_on_save, sender=Appointment, dispatch_uid='occupancy_save')
+    post_delete.connect(_on_delete, sender=Appointment, dispatch_uid='occupancy_delete')
+    for model in (Doctor, Clinic):
+        post_init.connect(_remember_zone, sender=model, dispatch_uid=f'occupancy_init_{model.__name__}')
+        post_save.connect(_on_zone_save, sender=model, dispatch_uid=f'occupancy_save_{model.__name__}')
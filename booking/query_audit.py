@@ -0,0 +1,186 @@
+"""
+Query auditing for tests.
+
+Views declare how many SQL queries a request may take with `@query_budget(n)` from
+booking.budget. While the audit middleware is installed (QueryAuditRunner does it for the test run) every statement
+of a request is recorded. A request fails when it exceeds the budget of its view or repeats
+the same statement shape with different parameters (N+1). A per request report is printed
+at the end of the run.
+"""
+import re
+import sys
+import time
+import typing
+from collections import Counter, defaultdict
+
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.runner import DiscoverRunner
+from django.test.utils import modify_settings
+
+MIDDLEWARE = 'booking.query_audit.QueryAuditMiddleware'
+N_PLUS_ONE_THRESHOLD = 3
+
+# transaction bookkeeping, not queries issued by the code under test
+_IGNORED = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.IGNORECASE)
+_IN_LIST = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def shape(sql: str) -> str:
+    """Statement with parameters, literals and IN lists collapsed, equal for N+1 repetitions"""
+    return _LITERAL.sub('?', _IN_LIST.sub('(%s...)', sql))
+
+
+class QueryRecorder:
+    """Records every statement executed on the default connection within the block"""
+
+    def __init__(self):
+        self.queries: typing.List[typing.Tuple[str, tuple, float]] = []
+        self.connections_opened = 0
+        self._wrapper = None
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        connection_created.connect(self._on_connection_created)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._on_connection_created)
+        self._wrapper.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if not _IGNORED.match(sql):
+                self.queries.append((sql, tuple(params or ()), time.perf_counter() - started))
+
+    def _on_connection_created(self, sender, **kwargs):
+        self.connections_opened += 1
+
+    def __len__(self):
+        return len(self.queries)
+
+    def n_plus_one(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> typing.Dict[str, int]:
+        """Statement shapes repeated at least `threshold` times with different parameters"""
+        params = defaultdict(set)
+        for sql, query_params, _ in self.queries:
+            params[shape(sql)].add(repr(query_params))
+        counts = Counter(shape(sql) for sql, _, _ in self.queries)
+        return {sql: count for sql, count in counts.items() if count >= threshold and len(params[sql]) > 1}
+
+
+class RequestAudit:
+    def __init__(self, test: str, method: str, path: str, view: str, budget, recorder: QueryRecorder):
+        self.test = test
+        self.method = method
+        self.path = path
+        self.view = view
+        self.budget = budget
+        self.queries = len(recorder)
+        self.connections_opened = recorder.connections_opened
+        self.duration = sum(duration for _, _, duration in recorder.queries)
+        self.n_plus_one = recorder.n_plus_one()
+
+    @property
+    def failures(self) -> typing.List[str]:
+        failures = []
+        if self.budget is not None and self.queries > self.budget:
+            failures.append(f'{self.view} took {self.queries} queries, budget is {self.budget}')
+        failures.extend(f'{self.view} repeats {count}x: {sql}' for sql, count in self.n_plus_one.items())
+        return failures
+
+
+class AuditLog:
+    def __init__(self):
+        self.current_test = None
+        self.requests: typing.List[RequestAudit] = []
+
+    def report(self) -> str:
+        lines = ['Query audit', f'{"queries":>8} {"budget":>7} {"conn":>5} {"ms":>7}  request']
+        for audit in self.requests:
+            budget = '-' if audit.budget is None else audit.budget
+            lines.append(f'{audit.queries:>8} {budget:>7} {audit.connections_opened:>5} {audit.duration * 1000:>7.2f}'
+                         f'  {audit.method} {audit.path} ({audit.view}) [{audit.test}]')
+            lines.extend(f'{"":>31}! {failure}' for failure in audit.failures)
+
+        per_view = defaultdict(list)
+        for audit in self.requests:
+            per_view[audit.view].append(audit.queries)
+        lines.append('')
+        lines.append(f'{"requests":>8} {"max":>7} {"mean":>7}  view')
+        for view, counts in sorted(per_view.items()):
+            lines.append(f'{len(counts):>8} {max(counts):>7} {sum(counts) / len(counts):>7.1f}  {view}')
+        failed = sum(bool(audit.failures) for audit in self.requests)
+        lines.append(f'{len(self.requests)} requests audited, {failed} over budget or with N+1 queries')
+        return '\n'.join(lines)
+
+
+audit_log = AuditLog()
+
+
+class QueryAuditMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.query_audit_view = None
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+
+        view = request.query_audit_view
+        audit = RequestAudit(
+            test=audit_log.current_test,
+            method=request.method,
+            path=request.path,
+            view=getattr(view, '__name__', '-'),
+            budget=getattr(view, 'query_budget', None),
+            recorder=recorder,
+        )
+        audit_log.requests.append(audit)
+        if audit.failures:
+            raise QueryBudgetExceeded('\n'.join(audit.failures))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_audit_view = view_func
+
+
+class QueryAuditRunner(DiscoverRunner):
+    """Test runner installing the audit middleware and printing the report after the run"""
+
+    def __init__(self, query_report=None, **kwargs):
+        super().__init__(**kwargs)
+        self.query_report = query_report
+
+    @classmethod
+    def add_arguments(cls, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--query-report', help='Also write the query audit report to this file.')
+
+    def get_resultclass(self):
+        base = super().get_resultclass() or self.test_runner.resultclass
+
+        class AuditedResult(base):
+            def startTest(self, test):
+                audit_log.current_test = test.id()
+                super().startTest(test)
+
+        return AuditedResult
+
+    def run_tests(self, *args, **kwargs):
+        with modify_settings(MIDDLEWARE={'append': MIDDLEWARE}):
+            result = super().run_tests(*args, **kwargs)
+        report = audit_log.report()
+        sys.stderr.write(f'\n{report}\n')
+        if self.query_report:
+            with open(self.query_report, 'w') as f:
+                f.write(report + '\n')
+        return result
@@ -1,5 +1,8 @@
 import abc
-from datetime import datetime
+import typing
+from datetime import date, datetime, tzinfo
+
+from django.utils import timezone
 
 
 class Range(abc.ABC):
@@ -23,14 +26,23 @@ class HoursRange(Range):
         return f'{self.start} <= current_hour < {self.end}'
 
 
+def _date(dt: datetime, tz: typing.Optional[tzinfo]) -> date:
+    if tz is None:
+        return dt.date()
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)  # in TIME_ZONE, like Django stores it
+    return timezone.localtime(dt, tz).date()
+
+
 class VisitTime:
-    def __init__(self, start: datetime, end: datetime):
+    def __init__(self, start: datetime, end: datetime, tz: typing.Optional[tzinfo] = None):
         """Visit time range. Performs validation of input parameters
         :param start: datetime we perform check for
         :param duration: duration of the visit
+        :param tz: time zone of the doctor, the visit has to stay within one of its days
         """
 
-        if start.date() != end.date():  # on the same date
+        if _date(start, tz) != _date(end, tz):  # on the same date
             raise ValueError("Visit should finish on the same day.")
 
         if start >= end:
@@ -0,0 +1,127 @@
+"""
+Working hours of doctors, compiled to UTC.
+
+Doctors work 9-18 on weekdays in their own time zone: the doctor's one, else the clinic's
+one, else TIME_ZONE. Working hours of a (time zone, day) are compiled once into UTC
+timestamps, DST included, so availability checks are plain integer comparisons.
+"""
+import functools
+import threading
+import typing
+from datetime import date, datetime, time
+
+import pytz
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from booking.models import Clinic, Doctor
+
+OPENING_HOUR = 9
+CLOSING_HOUR = 18
+WORKING_WEEKDAYS = range(5)  # Monday == 0 ... Sunday == 6
+
+# [start, end) of working hours as UTC timestamps
+Interval = typing.Tuple[int, int]
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_DAY_SECONDS = 24 * 60 * 60
+
+
+@functools.lru_cache(maxsize=16384)
+def working_intervals(tz_name: str, day: date) -> typing.Tuple[Interval, ...]:
+    """Working hours of a local calendar day in UTC, empty for days off"""
+    if day.weekday() not in WORKING_WEEKDAYS:
+        return ()
+    tz = pytz.timezone(tz_name)
+    return (_timestamp(tz, day, OPENING_HOUR), _timestamp(tz, day, CLOSING_HOUR)),
+
+
+def _timestamp(tz, day: date, hour: int) -> int:
+    # wall clock times skipped or repeated by a DST transition resolve to standard time
+    return int(tz.normalize(tz.localize(datetime.combine(day, time(hour)), is_dst=False)).timestamp())
+
+
+def to_timestamp(dt: datetime) -> float:
+    """UTC timestamp, naive datetimes are taken in the current time zone like Django does"""
+    return (timezone.make_aware(dt) if dt.tzinfo is None else dt).timestamp()
+
+
+def from_timestamp(ts: float) -> datetime:
+    dt = datetime.fromtimestamp(ts, pytz.utc)
+    return dt if settings.USE_TZ else timezone.make_naive(dt)
+
+
+def local_date(ts: float, tz_name: str) -> date:
+    return datetime.fromtimestamp(ts, pytz.timezone(tz_name)).date()
+
+
+@functools.lru_cache(maxsize=16384)
+def _working_intervals_by_ordinal(tz_name: str, ordinal: int) -> typing.Tuple[Interval, ...]:
+    return working_intervals(tz_name, date.fromordinal(ordinal))
+
+
+def working_interval_at(ts: float, tz_name: str) -> typing.Optional[Interval]:
+    """Working hours containing the timestamp, looked up among the days around its UTC date"""
+    utc_day = _EPOCH_ORDINAL + int(ts // _DAY_SECONDS)
+    for ordinal in (utc_day, utc_day - 1, utc_day + 1):
+        for start, end in _working_intervals_by_ordinal(tz_name, ordinal):
+            if start <= ts < end:
+                return start, end
+    return None
+
+
+# doctor_id -> time zone name, only kept for the duration of a request of the current thread.
+# Outside of requests (management commands, shells, workers) time zones are always read from
+# the database, other processes may have changed them meanwhile.
+_request = threading.local()
+
+
+def _cache() -> typing.Optional[typing.Dict[int, str]]:
+    return getattr(_request, 'doctor_timezones', None)
+
+
+def doctor_timezone(doctor_id) -> str:
+    cache = _cache()
+    tz_name = cache.get(doctor_id) if cache is not None else None
+    if tz_name is None:
+        row = Doctor.objects.filter(pk=doctor_id).values_list('timezone', 'clinic__timezone').first()
+        tz_name = (row and (row[0] or row[1])) or settings.TIME_ZONE
+        if cache is not None:
+            cache[doctor_id] = tz_name
+    return tz_name
+
+
+def doctor_timezones(doctors) -> typing.Dict[int, str]:
+    """Time zones of all the doctors of a queryset in one query"""
+    timezones = {
+        doctor_id: tz_name or clinic_tz_name or settings.TIME_ZONE
+        for doctor_id, tz_name, clinic_tz_name in doctors.values_list('pk', 'timezone', 'clinic__timezone')
+    }
+    cache = _cache()
+    if cache is not None:
+        cache.update(timezones)
+    return timezones
+
+
+def clear_doctor_timezones(**kwargs):
+    cache = _cache()
+    if cache is not None:
+        cache.clear()
+
+
+def _start_request(**kwargs):
+    _request.doctor_timezones = {}
+
+
+def _finish_request(**kwargs):
+    _request.doctor_timezones = None
+
+
+def connect_signals():
+    request_started.connect(_start_request, dispatch_uid='schedule_request_started')
+    request_finished.connect(_finish_request, dispatch_uid='schedule_request_finished')
+    for model in (Doctor, Clinic):
+        post_save.connect(clear_doctor_timezones, sender=model, dispatch_uid=f'schedule_save_{model.__name__}')
+        post_delete.connect(clear_doctor_timezones, sender=model, dispatch_uid=f'schedule_delete_{model.__name__}')
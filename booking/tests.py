@@ -1,10 +1,26 @@
+import importlib
 import json
 from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-from django.test import TestCase, Client
+from django.apps import apps
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase, Client, modify_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from booking.models import Appointment, Patient
+import pytz
+
+from booking.alternatives import AlternativeSlotsEngine, search_chunk
+from booking.booking_service import WorkingDayAndHourAvailabilityFilter
+from booking.models import Appointment, AppointmentChange, Clinic, Doctor, Patient, DoctorDayOccupancy
+from booking import views
+from booking.occupancy import OccupancyService, interval_mask
+from booking.query_audit import MIDDLEWARE, QueryBudgetExceeded, QueryRecorder, shape
+from booking.schedule import doctor_timezone, to_timestamp, working_intervals
+from booking.range import VisitTime
 
 
 class TestListView(TestCase):
@@ -214,3 +230,457 @@ class TestBookingTwoPatientsConflicts(TestCase):
         }, content_type='application/json')
 
         self.assertEquals(response.status_code, 201)
+
+
+class TestBackToBackVisits(TestCase):
+
+    def setUp(self) -> None:
+        self._patient2 = Patient(email='Jane.Doe@gmail.com', name='Jane Doe', )
+        self._patient2.save()
+        # 10:20:30 - 12:40:30, both ends fall inside 5 minute slots
+        self._start_at = _start_at.replace(second=30, microsecond=0)
+        self._finish_at = _finish_at.replace(second=30, microsecond=0)
+        self._client = Client()
+
+    def _book(self, start, finish):
+        return self._client.post(reverse('bookings'), data={
+            "appointment_start": start,
+            "appointment_finish": finish,
+            "doctor_id": 1
+        }, content_type='application/json').status_code
+
+    def test_same_rule_for_doctor_and_patient(self):
+        for doctor_id, patient_id in [(1, self._patient2.pk), (2, 1)]:  # the doctor's, then the patient's time
+            with self.subTest(doctor_id=doctor_id, patient_id=patient_id):
+                Appointment.objects.all().delete()
+                Appointment(
+                    doctor_id=doctor_id,
+                    patient_id=patient_id,
+                    appointment_start=self._start_at,
+                    appointment_finish=self._finish_at
+                ).save()
+
+                self.assertEquals(self._book(self._finish_at - timedelta(seconds=1), self._finish_at + timedelta(minutes=30)), 409)
+                self.assertEquals(self._book(self._start_at - timedelta(minutes=30), self._start_at), 201)
+                self.assertEquals(self._book(self._finish_at, self._finish_at + timedelta(minutes=30)), 201)
+
+
+class TestOccupancyBitmap(TestCase):
+
+    def setUp(self) -> None:
+        self._day = _start_at.date()
+        self._appointment = Appointment(
+            doctor_id=1,
+            patient_id=1,
+            appointment_start=_start_at,
+            appointment_finish=_finish_at
+        )
+        self._appointment.save()
+
+    def test_interval_mask_rounds_to_slots(self):
+        (day_start, _), = working_intervals('UTC', self._day)
+        start, finish = to_timestamp(_start_at), to_timestamp(_finish_at)
+        # 10:20:58 - 12:40:58 touches slots 10:20 ... 12:40
+        self.assertEquals(interval_mask(start, finish, day_start), ((1 << 29) - 1) << 16)
+        self.assertEquals(interval_mask(start - 5 * 3600, start - 2 * 3600, day_start), 0)
+
+    def test_bitmap_follows_appointment_changes(self):
+        visit = VisitTime(_start_at + timedelta(hours=1), _finish_at + timedelta(hours=1))
+        self.assertTrue(OccupancyService.is_doctor_busy(1, visit))
+        self.assertFalse(OccupancyService.is_doctor_busy(2, visit))
+
+        self._appointment.status = Appointment.AppointmentStatus.CANCELLED
+        self._appointment.save()
+        self.assertFalse(OccupancyService.is_doctor_busy(1, visit))
+
+        self._appointment.status = Appointment.AppointmentStatus.OPEN
+        self._appointment.doctor_id = 2
+        self._appointment.save()
+        self.assertFalse(OccupancyService.is_doctor_busy(1, visit))
+        self.assertTrue(OccupancyService.is_doctor_busy(2, visit))
+
+        Appointment.objects.get(pk=self._appointment.pk).delete()
+        self.assertFalse(OccupancyService.is_doctor_busy(2, visit))
+
+    def test_free_intervals(self):
+        day_start = _start_at.replace(hour=9, minute=0, second=0, microsecond=0)
+        free = [(start.replace(tzinfo=None), end.replace(tzinfo=None))
+                for start, end in OccupancyService.free_intervals(1, self._day)]
+        self.assertEquals(free, [
+            (day_start, day_start + timedelta(hours=1, minutes=20)),
+            (day_start + timedelta(hours=3, minutes=45), day_start + timedelta(hours=9)),
+        ])
+
+    def test_migration_backfills_existing_appointments(self):
+        backfill_bitmaps = importlib.import_module('booking.migrations.0003_doctordayoccupancy').backfill_bitmaps
+        # appointments booked before the bitmaps existed
+        DoctorDayOccupancy.objects.all().delete()
+        Appointment.objects.bulk_create([Appointment(
+            doctor_id=2,
+            patient_id=1,
+            appointment_start=_start_at,
+            appointment_finish=_finish_at
+        )])
+
+        backfill_bitmaps(apps, None)
+        self.assertEquals(set(DoctorDayOccupancy.objects.values_list('doctor_id', 'day')),
+                          {(1, self._day), (2, self._day)})
+        patient2 = Patient(email='Jane.Doe@gmail.com', name='Jane Doe', )
+        patient2.save()
+        with mock.patch.object(views.book_appointment.__wrapped__, '__defaults__', (patient2.pk,)):
+            response = Client().post(reverse('bookings'), data={
+                "appointment_start": _start_at + timedelta(hours=1),
+                "appointment_finish": _finish_at + timedelta(hours=1),
+                "doctor_id": 2
+            }, content_type='application/json')
+        self.assertEquals(response.status_code, 409)
+
+    def test_rebuild_reports_and_fixes_drift(self):
+        Appointment.objects.filter(pk=self._appointment.pk).update(doctor_id=2)  # bypasses signals
+
+        out = StringIO()
+        call_command('rebuild_occupancy', '--verify', stdout=out)
+        self.assertIn('1 missing, 0 outdated, 1 stale', out.getvalue())
+
+        call_command('rebuild_occupancy', stdout=StringIO())
+        self.assertFalse(DoctorDayOccupancy.objects.filter(doctor_id=1, day=self._day).exists())
+        out = StringIO()
+        call_command('rebuild_occupancy', '--verify', stdout=out)
+        self.assertIn('No drift', out.getvalue())
+
+
+class TestAlternativeSlots(TestCase):
+
+    def setUp(self) -> None:
+        today = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0)
+        self._start_at = today + timedelta(days=7 - today.weekday())  # next monday, 10:00
+        self._colleague = Doctor(email='James.Wilson@gmail.com', name='Dr. James Wilson', specialization='physician')
+        self._colleague.save()
+        self._patient2 = Patient(email='Jane.Doe@gmail.com', name='Jane Doe', )
+        self._patient2.save()
+        Appointment(
+            doctor_id=2,
+            patient_id=self._patient2.pk,
+            appointment_start=self._start_at,
+            appointment_finish=self._start_at + timedelta(hours=1)
+        ).save()
+        self._client = Client()
+
+    def test_conflict_suggests_nearest_slots(self):
+        response = self._client.post(reverse('bookings'), data={
+            "appointment_start": self._start_at,
+            "appointment_finish": self._start_at + timedelta(hours=1),
+            "doctor_id": 2
+        }, content_type='application/json')
+        self.assertEquals(response.status_code, 409)
+
+        data = json.loads(response.content)
+        self.assertTrue(data['alternatives_complete'])
+        self.assertEquals(len(data['alternatives']), 5)
+        self.assertEquals(data['alternatives'][0]['doctor_id'], self._colleague.pk)
+        self.assertEquals(datetime.fromisoformat(data['alternatives'][0]['appointment_start']), self._start_at)
+        self.assertNotIn(1, {alternative['doctor_id'] for alternative in data['alternatives']})
+
+    def test_skips_busy_time_of_the_doctor_and_the_patient(self):
+        engine = AlternativeSlotsEngine(limit=2)
+        visit = VisitTime(self._start_at + timedelta(minutes=30), self._start_at + timedelta(minutes=90))
+
+        suggested, _ = engine.suggest(visit, 1, 2)
+        self.assertEquals([doctor_id for doctor_id, _ in suggested], [self._colleague.pk, self._colleague.pk])
+
+        suggested, _ = engine.suggest(visit, self._patient2.pk, 2)
+        for _, alternative in suggested:
+            self.assertFalse(alternative.start < self._start_at + timedelta(hours=1) and
+                             alternative.end > self._start_at)
+
+    def test_process_pool_matches_inline_search(self):
+        visit = VisitTime(self._start_at, self._start_at + timedelta(minutes=45))
+        inline, _ = AlternativeSlotsEngine().suggest(visit, 1, 2)
+
+        engine = AlternativeSlotsEngine(inline_below=0, chunk_size=1, workers=2, budget=30)
+        try:
+            pooled, complete = engine.suggest(visit, 1, 2)
+        finally:
+            engine.shutdown()
+        self.assertTrue(complete)
+        self.assertEquals([(d, v.start) for d, v in pooled], [(d, v.start) for d, v in inline])
+
+    def test_budget_returns_results_found_so_far(self):
+        visit = VisitTime(self._start_at, self._start_at + timedelta(minutes=30))
+        self.assertEquals(AlternativeSlotsEngine(budget=0).suggest(visit, 1, 2), ([], False))
+
+        (monday, _), = working_intervals('UTC', self._start_at.date())
+        tuesday = monday + 24 * 3600
+        candidates = [(2, monday, 0), (2, tuesday, 0)]
+        # the clock passes the deadline after the requested day has been searched
+        with mock.patch('booking.alternatives.time.time', side_effect=[0, 1]):
+            found, complete = search_chunk(candidates, [], 2, tuesday + 3600, 0, 1800, 200, 0.5)
+        self.assertFalse(complete)
+        self.assertEquals(len(found), 102)  # 9:00 ... 17:25, visits finish before closing
+        self.assertTrue(all(tuesday <= start < tuesday + 9 * 3600 for _, _, _, start in found))
+
+
+@modify_settings(MIDDLEWARE={'append': MIDDLEWARE})
+class TestQueryAudit(TestCase):
+
+    def setUp(self) -> None:
+        for hours in range(3):
+            patient = Patient(email=f'patient{hours}@gmail.com', name=f'Patient {hours}')
+            patient.save()
+            Appointment(
+                doctor_id=1 + hours % 2,
+                patient_id=patient.pk,
+                appointment_start=_start_at + timedelta(hours=hours),
+                appointment_finish=_start_at + timedelta(hours=hours, minutes=30)
+            ).save()
+        self._client = Client()
+
+    def test_shape_collapses_parameters(self):
+        self.assertEquals(shape('SELECT * FROM t WHERE id IN (%s, %s, %s) AND x = 10'),
+                          shape('SELECT * FROM t WHERE id IN (%s, %s) AND x = 12'))
+
+    def test_lazy_foreign_keys_detected_as_n_plus_one(self):
+        with QueryRecorder() as recorder:
+            [str(appointment) for appointment in Appointment.objects.all()]
+        self.assertEquals(len(recorder), 7)
+        self.assertEquals(sorted(recorder.n_plus_one().values()), [3, 3])
+
+        with QueryRecorder() as recorder:
+            [str(appointment) for appointment in Appointment.objects.select_related('doctor', 'patient')]
+        self.assertEquals(len(recorder), 1)
+        self.assertFalse(recorder.n_plus_one())
+
+    def test_request_over_budget_fails(self):
+        url = reverse('perday', args=(_start_at,))
+        self.assertEquals(self._client.get(url).status_code, 200)
+
+        with mock.patch.object(views.list_appointments, 'query_budget', 0):
+            with self.assertRaises(QueryBudgetExceeded):
+                self._client.get(url)
+
+
+def _utc(iso: str) -> datetime:
+    return datetime.fromisoformat(iso).replace(tzinfo=pytz.utc)
+
+
+class TestTimezoneWorkingHours(TestCase):
+
+    def setUp(self) -> None:
+        clinic = Clinic(name='Princeton-Plainsboro', timezone='America/New_York')
+        clinic.save()
+        self._doctor = Doctor(email='Lisa.Cuddy@gmail.com', name='Dr. Lisa Cuddy', specialization='endocrinology',
+                              clinic=clinic)
+        self._doctor.save()
+        self._filter = WorkingDayAndHourAvailabilityFilter()
+
+    def _check(self, start: str, finish: str, doctor_id=None):
+        return self._filter(VisitTime(_utc(start), _utc(finish)), 1, doctor_id or self._doctor.pk)
+
+    def test_intervals_follow_dst(self):
+        for tz_name, day, opening in [
+            ('America/New_York', '2021-03-12', '2021-03-12T14:00'),  # EST
+            ('America/New_York', '2021-03-15', '2021-03-15T13:00'),  # EDT, the day after spring forward
+            ('America/New_York', '2021-11-05', '2021-11-05T13:00'),  # EDT
+            ('America/New_York', '2021-11-08', '2021-11-08T14:00'),  # EST, the day after fall back
+            ('Africa/Cairo', '2023-04-27', '2023-04-27T07:00'),  # EET
+            ('Africa/Cairo', '2023-04-28', '2023-04-28T06:00'),  # EEST starts at midnight of a working day
+        ]:
+            opening = int(_utc(opening).timestamp())
+            self.assertEquals(working_intervals(tz_name, datetime.fromisoformat(day).date()),
+                              ((opening, opening + 9 * 3600),))
+        self.assertEquals(working_intervals('America/New_York', datetime.fromisoformat('2021-03-14').date()), ())
+
+    def test_clinic_working_hours_across_dst(self):
+        self.assertEquals(self._check('2021-03-12T13:30', '2021-03-12T14:30'), (False, ['Close hours.']))
+        self.assertEquals(self._check('2021-03-15T13:30', '2021-03-15T14:30'), (True, []))
+        self.assertEquals(self._check('2021-03-15T21:30', '2021-03-15T21:50'), (True, []))
+        self.assertEquals(self._check('2021-03-15T21:30', '2021-03-15T22:00'), (False, ['Close hours.']))
+        self.assertEquals(self._check('2021-11-08T13:30', '2021-11-08T14:30'), (False, ['Close hours.']))
+        self.assertEquals(self._check('2021-11-08T22:30', '2021-11-08T22:50'), (True, []))
+        # default time zone without a clinic
+        self.assertEquals(self._check('2021-03-15T21:30', '2021-03-15T21:50', doctor_id=2), (False, ['Close hours.']))
+
+    def test_doctor_timezone_overrides_clinic(self):
+        self._doctor.timezone = 'Asia/Tokyo'
+        self._doctor.save()
+        self.assertEquals(self._check('2021-03-15T01:00', '2021-03-15T02:00'), (True, []))
+        # Friday in UTC, Saturday morning in Tokyo
+        self.assertEquals(self._check('2021-03-12T23:30', '2021-03-12T23:50'),
+                          (False, ["Booking couldn't be made on the weekend."]))
+
+    def test_occupancy_in_clinic_timezone(self):
+        # 17:00 EDT is outside of 9-18 UTC, still within the doctor's working hours
+        Appointment(
+            doctor_id=self._doctor.pk,
+            patient_id=1,
+            appointment_start=_utc('2021-03-15T21:00'),
+            appointment_finish=_utc('2021-03-15T21:30')
+        ).save()
+        self.assertTrue(OccupancyService.is_doctor_busy(
+            self._doctor.pk, VisitTime(_utc('2021-03-15T21:20'), _utc('2021-03-15T21:40'))))
+        self.assertEquals(OccupancyService.free_intervals(self._doctor.pk, datetime.fromisoformat('2021-03-15').date()), [
+            (_utc('2021-03-15T13:00'), _utc('2021-03-15T21:00')),
+            (_utc('2021-03-15T21:30'), _utc('2021-03-15T22:00')),
+        ])
+
+    def test_timezone_change_moves_bitmaps(self):
+        patient2 = Patient(email='Jane.Doe@gmail.com', name='Jane Doe', )
+        patient2.save()
+        Appointment(
+            doctor_id=self._doctor.pk,
+            patient_id=patient2.pk,
+            appointment_start=_utc('2021-03-15T21:00'),
+            appointment_finish=_utc('2021-03-15T21:30')
+        ).save()
+        visit = VisitTime(_utc('2021-03-15T21:10'), _utc('2021-03-15T21:20'))
+
+        for model, tz_name in [(self._doctor.clinic, 'America/Los_Angeles'), (self._doctor, 'America/Chicago')]:
+            model.timezone = tz_name
+            model.save()
+            self.assertTrue(OccupancyService.is_doctor_busy(self._doctor.pk, visit))
+            response = self._book('2021-03-15T21:10:00+00:00', '2021-03-15T21:20:00+00:00')
+            self.assertEquals(response.status_code, 409)
+
+    def test_rebuild_reads_timezones_changed_elsewhere(self):
+        Appointment(
+            doctor_id=self._doctor.pk,
+            patient_id=1,
+            appointment_start=_utc('2021-03-15T21:00'),
+            appointment_finish=_utc('2021-03-15T21:30')
+        ).save()
+        self.assertEquals(doctor_timezone(self._doctor.pk), 'America/New_York')
+        # changed by another process, no signals reach this one
+        Clinic.objects.filter(pk=self._doctor.clinic_id).update(timezone='America/Los_Angeles')
+        self.assertEquals(doctor_timezone(self._doctor.pk), 'America/Los_Angeles')
+
+        call_command('rebuild_occupancy', stdout=StringIO())
+        self.assertTrue(OccupancyService.is_doctor_busy(
+            self._doctor.pk, VisitTime(_utc('2021-03-15T21:10'), _utc('2021-03-15T21:20'))))
+
+    def _book(self, start: str, finish: str):
+        return Client().post(reverse('bookings'), data={
+            "appointment_start": start,
+            "appointment_finish": finish,
+            "doctor_id": self._doctor.pk
+        }, content_type='application/json')
+
+    def test_same_day_in_doctor_timezone(self):
+        self.assertEquals(self._book('2021-03-15T16:00:00-04:00', '2021-03-15T17:30:00-04:00').status_code, 201)
+        # 23:00 - 01:00 in New York on the same UTC day
+        response = self._book('2021-03-16T03:00:00', '2021-03-16T05:00:00')
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(json.loads(response.content)['reasons'], ['Visit should finish on the same day.'])
+
+        self._doctor.timezone = 'America/Los_Angeles'
+        self._doctor.save()
+        # 16:00 - 17:30 in Los Angeles, across the UTC midnight
+        self.assertEquals(self._book('2021-03-16T23:00:00', '2021-03-17T00:30:00').status_code, 201)
+
+
+class TestChangeFeed(TestCase):
+
+    def setUp(self) -> None:
+        self._appointment = Appointment(
+            doctor_id=1,
+            patient_id=1,
+            appointment_start=_start_at,
+            appointment_finish=_finish_at
+        )
+        self._appointment.save()
+        self._appointment.status = Appointment.AppointmentStatus.CANCELLED
+        self._appointment.save()
+
+        self._patient2 = Patient(email='Jane.Doe@gmail.com', name='Jane Doe', )
+        self._patient2.save()
+        Appointment(
+            doctor_id=2,
+            patient_id=self._patient2.pk,
+            appointment_start=_start_at,
+            appointment_finish=_finish_at
+        ).save()
+        self._client = Client()
+
+    def _changes(self, **params):
+        response = self._client.get(reverse('changes'), data=params)
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_changes_since_cursor(self):
+        data = self._changes(since=0)
+        self.assertEquals([(c['action'], c['version']) for c in data['changes']], [('CREATED', 1), ('UPDATED', 2)])
+        self.assertEquals(data['changes'][1]['appointment']['status'], 'CANCELLED')
+        self.assertFalse(data['has_more'])
+
+        cursor = data['cursor']
+        self.assertEquals(self._changes(since=cursor), {"changes": [], "cursor": cursor, "has_more": False})
+
+        Appointment.objects.get(pk=self._appointment.pk).delete()
+        data = self._changes(since=cursor)
+        self.assertEquals([(c['action'], c['version'], c['appointment']) for c in data['changes']],
+                          [('DELETED', 3, None)])
+        self.assertGreater(data['cursor'], cursor)
+
+    def test_changes_paginated(self):
+        data = self._changes(since=0, limit=1)
+        self.assertTrue(data['has_more'])
+        data = self._changes(since=data['cursor'], limit=1)
+        self.assertEquals(data['changes'][0]['action'], 'UPDATED')
+
+    def test_versions_increase_with_stale_instances(self):
+        first = Appointment.objects.get(pk=self._appointment.pk)
+        second = Appointment.objects.get(pk=self._appointment.pk)
+        first.save()
+        second.save()
+        self.assertEquals((first.version, second.version), (3, 4))
+
+        with mock.patch('booking.changes.AppointmentChange.objects.create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                second.save()
+        self.assertEquals(second.version, 4)
+
+        first.delete()
+        versions = AppointmentChange.objects.filter(appointment_id=self._appointment.pk).values_list('version', flat=True)
+        self.assertEquals(list(versions), [1, 2, 3, 4, 5])
+
+    def test_partial_saves_bump_the_version(self):
+        appointment = Appointment.objects.get(pk=self._appointment.pk)
+        for status in (Appointment.AppointmentStatus.OPEN, Appointment.AppointmentStatus.USED):
+            appointment.status = status
+            appointment.save(update_fields=['status'])
+
+        self.assertEquals(Appointment.objects.get(pk=self._appointment.pk).version, 4)
+        versions = AppointmentChange.objects.filter(appointment_id=self._appointment.pk).values_list('version', flat=True)
+        self.assertEquals(list(versions), [1, 2, 3, 4])
+
+    def test_moved_appointment_deleted_from_previous_patient_feed(self):
+        appointment = Appointment.objects.get(pk=self._appointment.pk)
+        appointment.patient_id = self._patient2.pk
+        appointment.save()
+
+        changes = AppointmentChange.objects.filter(appointment_id=appointment.pk).order_by('id')
+        self.assertEquals([(c.patient_id, c.action, c.version) for c in changes][2:], [
+            (1, 'DELETED', 3),
+            (self._patient2.pk, 'UPDATED', 3),
+        ])
+
+    def test_long_poll_returns_new_changes(self):
+        cursor = self._changes()['cursor']
+
+        def book_meanwhile(_):
+            Appointment(
+                doctor_id=2,
+                patient_id=1,
+                appointment_start=_start_at + timedelta(hours=3),
+                appointment_finish=_finish_at + timedelta(hours=3)
+            ).save()
+
+        with mock.patch('booking.changes.time.sleep', side_effect=book_meanwhile) as sleep:
+            data = self._changes(since=cursor, wait=10)
+        self.assertEquals(sleep.call_count, 1)
+        self.assertEquals([c['action'] for c in data['changes']], ['CREATED'])
+
+    def test_invalid_cursor(self):
+        for params in [{'since': 'abc'}, {'since': -1}, {'limit': 0}, {'wait': 'x'}, {'wait': 'nan'}, {'wait': 'inf'}]:
+            response = self._client.get(reverse('changes'), data=params)
+            self.assertEquals(response.status_code, 400)
+        self.assertEquals(AppointmentChange.objects.filter(patient_id=self._patient2.pk).count(), 1)
@@ -21,4 +21,5 @@ register_converter(DateConverter, 'day')
 urlpatterns = [
     path('appointments/dates/<day:for_date>', views.list_appointments, name='perday'),
     path('appointments/', views.book_appointment, name='bookings'),
+    path('appointments/changes', views.appointment_changes, name='changes'),
 ]
@@ -1,16 +1,22 @@
 import json
+import math
 from datetime import date, timedelta, datetime
 
+import pytz
 from django.forms import model_to_dict
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
+from booking import alternatives, schedule
 from booking.range import VisitTime
 from booking.models import Appointment
 from booking.booking_service import BookingService
+from booking.budget import query_budget
+from booking.changes import ChangeFeed, MAX_LIMIT, MAX_WAIT, POLL_INTERVAL
 
 
 @csrf_exempt
+@query_budget(1)
 def list_appointments(request, for_date: date, current_user_id=1):
     """List available appointments for a specific day for a specific user."""
 
@@ -22,6 +28,9 @@ def list_appointments(request, for_date: date, current_user_id=1):
 
 
 @csrf_exempt
+# doctor time zone 1, doctor bitmap and overlapping appointments 2, appointment insert 1,
+# bitmap refresh 3 (lock, recompute, write), change feed 2 (patient lock, insert)
+@query_budget(9)
 def book_appointment(request, current_user_id=1):
     """Allow patients to only book appointment."""
     if request.method != 'POST':
@@ -32,13 +41,22 @@ def book_appointment(request, current_user_id=1):
     appointment_finish: datetime = datetime.fromisoformat(payload['appointment_finish'])
 
     try:
-        visit_time = VisitTime(appointment_start, appointment_finish)
+        visit_time = VisitTime(appointment_start, appointment_finish, pytz.timezone(schedule.doctor_timezone(doctor_id)))
     except ValueError as e:
         return JsonResponse(status=400, data={"reasons": [str(e)]})
 
     is_available, reasons = BookingService.check_appointment_time_availability(current_user_id, doctor_id, visit_time)
     if not is_available:
-        return JsonResponse(status=409, data={"reasons": reasons})
+        suggested, complete = alternatives.engine.suggest(visit_time, current_user_id, doctor_id)
+        return JsonResponse(status=409, data={
+            "reasons": reasons,
+            "alternatives": [{
+                "doctor_id": alternative_doctor_id,
+                "appointment_start": alternative.start.isoformat(),
+                "appointment_finish": alternative.end.isoformat(),
+            } for alternative_doctor_id, alternative in suggested],
+            "alternatives_complete": complete,
+        })
 
     appointment = Appointment(
         patient_id=current_user_id,
@@ -48,3 +66,32 @@ def book_appointment(request, current_user_id=1):
     )
     appointment.save()
     return JsonResponse(status=201, data=model_to_dict(appointment))
+
+
+@csrf_exempt
+@query_budget(int(MAX_WAIT / POLL_INTERVAL) + 1)  # a query per poll
+def appointment_changes(request, current_user_id=1):
+    """Changes of the user's appointments after the `since` cursor, waiting up to `wait` seconds for new ones."""
+    if request.method != 'GET':
+        return JsonResponse(status=405, data={"reasons": ['Method Not Allowed']})
+    try:
+        since = int(request.GET.get('since', 0))
+        wait = float(request.GET.get('wait', 0))
+        limit = min(int(request.GET.get('limit', MAX_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        return JsonResponse(status=400, data={"reasons": ['Invalid since, wait or limit.']})
+    if since < 0 or not math.isfinite(wait) or wait < 0 or limit < 1:
+        return JsonResponse(status=400, data={"reasons": ['Invalid since, wait or limit.']})
+
+    changes = ChangeFeed.wait_for_changes(current_user_id, since, limit, wait)
+    return JsonResponse(status=200, data={
+        "changes": [{
+            "cursor": change.id,
+            "action": change.action,
+            "appointment_id": change.appointment_id,
+            "version": change.version,
+            "appointment": json.loads(change.payload) if change.payload else None,
+        } for change in changes],
+        "cursor": changes[-1].id if changes else since,
+        "has_more": len(changes) == limit,
+    })
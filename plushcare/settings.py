@@ -70,6 +70,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'plushcare.wsgi.application'
 
+# Audits SQL queries of every request made by tests against the views' declared budgets
+TEST_RUNNER = 'booking.query_audit.QueryAuditRunner'
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases